@@ -2,15 +2,15 @@
 import streamlit as st
 from datetime import date, datetime, timedelta
 import pandas as pd
+import numpy as np
 import plotly.express as px
 from plotly.subplots import make_subplots
 import plotly.graph_objects as go
-import requests
-from sqlalchemy import func, case, and_, or_
+from sqlalchemy import case, and_, or_, text, select, type_coerce, String
 
 # Import database and models
-from database import db_session, init_db, verify_password, get_db_session, close_db
-from models import User, Account, Transaction, ExchangeRate, Category, TransactionType, TransactionSplit
+from database import db_session, init_db, verify_password, hash_password, needs_rehash, close_db, session_scope
+from models import User, Account, Transaction, ExchangeRate, Category, TransactionType, TransactionSplit, round_amount
 
 # --- Page Configuration ---
 st.set_page_config(
@@ -20,6 +20,12 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
+# USD to INR rate used until the first rate has been fetched
+FALLBACK_EXCHANGE_RATE = 83.0
+
+# Number of rows shown per page on the View Transactions page
+TRANSACTIONS_PAGE_SIZE = 500
+
 # --- Session State Initialization ---
 if 'authenticated' not in st.session_state:
     st.session_state.authenticated = False
@@ -29,157 +35,140 @@ if 'authenticated' not in st.session_state:
     st.session_state.force_rerun = False  # Flag to control reruns
 
 # --- Helper Functions ---
-def get_latest_exchange_rate():
-    """Fetches and returns the latest USD to INR rate from the database."""
-    session = get_db_session()
-    try:
+@st.cache_data(ttl=3600, show_spinner=False)
+def get_stored_exchange_rate(_session=None):
+    """Returns the latest stored USD to INR rate, or None if no rate has been stored."""
+    with session_scope(_session) as session:
         latest_rate = session.query(ExchangeRate).order_by(ExchangeRate.date.desc()).first()
         if latest_rate:
             return latest_rate.usd_to_inr
-        else:
-            return fetch_and_store_exchange_rate()
-    finally:
-        session.close()
+        return None
 
-def fetch_and_store_exchange_rate():
-    """Fetches the current USD/INR rate from Frankfurter.app and stores it in the DB."""
-    try:
-        response = requests.get("https://api.frankfurter.app/latest?from=USD&to=INR")
-        response.raise_for_status()
-        data = response.json()
-        current_rate = data['rates']['INR']
-        
-        session = get_db_session()
-        try:
-            today = date.today()
-            existing_rate = session.query(ExchangeRate).filter(ExchangeRate.date == today).first()
-            if not existing_rate:
-                new_rate = ExchangeRate(date=today, usd_to_inr=current_rate)
-                session.add(new_rate)
-                session.commit()
-                st.success(f"Fetched and stored new exchange rate: 1 USD = {current_rate} INR")
-            else:
-                existing_rate.usd_to_inr = current_rate
-                session.commit()
-            return current_rate
-        finally:
-            session.close()
-    except requests.RequestException as e:
-        st.error(f"Failed to fetch exchange rate: {e}")
-        return 83.0
-    except Exception as e:
-        st.error(f"An error occurred: {e}")
-        return 83.0
+def get_latest_exchange_rate(session=None):
+    """Returns the latest stored USD to INR rate, or a fallback rate if none has been fetched yet."""
+    latest_rate = get_stored_exchange_rate(session)
+    if latest_rate is None:
+        # Don't keep the miss cached while the background fetch is still running
+        get_stored_exchange_rate.clear()
+        st.toast(f"No exchange rate stored yet, using {FALLBACK_EXCHANGE_RATE:.2f} INR per USD.", icon="⚠️")
+        return FALLBACK_EXCHANGE_RATE
+    return latest_rate
 
-def get_account_balance(account_id):
-    """Calculates the current balance for a given account ID."""
-    session = get_db_session()
-    try:
-        account = session.query(Account).filter(Account.id == account_id).first()
-        if account:
-            return account.balance
-        return 0.0
-    finally:
-        session.close()
+# All dashboard aggregates in a single round-trip, one (scope, label, income, expense) row per group.
+# Income and expense are summed side by side, so no scope needs pivoting afterwards.
+DASHBOARD_SQL = text("""
+    SELECT 'balance' AS scope, account_id AS label, balance_cents / 100.0 AS income, 0 AS expense
+    FROM account_balances
+    UNION ALL
+    SELECT 'profit_loss', COALESCE(year_month, CAST(strftime('%Y%m', date) AS INTEGER)),
+        SUM(CASE WHEN type = :income THEN amount ELSE 0 END),
+        SUM(CASE WHEN type = :expense THEN amount ELSE 0 END)
+    FROM transactions
+    WHERE is_void = 0 AND date >= :start_date
+    -- Rows written outside the app may not have their bucket backfilled yet
+    GROUP BY COALESCE(year_month, CAST(strftime('%Y%m', date) AS INTEGER))
+    UNION ALL
+    SELECT 'income', counterparty, SUM(amount), 0
+    FROM transactions
+    WHERE is_void = 0 AND type = :income AND counterparty IS NOT NULL AND counterparty != ''
+    GROUP BY counterparty
+    UNION ALL
+    SELECT 'expense', categories.name, 0, SUM(transactions.amount)
+    FROM transactions
+    JOIN categories ON categories.id = transactions.category_id
+    WHERE transactions.is_void = 0 AND transactions.type = :expense
+        AND categories.name NOT LIKE :transfer_pattern
+    GROUP BY categories.name
+""")
 
-def get_profit_loss_data(months=6):
-    """Gets Income and Expense data for the last 'n' months for the chart."""
-    session = get_db_session()
-    try:
+@st.cache_data(ttl=60, show_spinner=False)
+def get_dashboard_data(months=6, _session=None):
+    """
+    Gets account balances and the chart data for the dashboard in one query.
+    Returns a (balances, profit_loss_df, income_df, expenses_df) tuple, where
+    balances maps account IDs to their current balance.
+    """
+    with session_scope(_session) as session:
         start_date = date.today() - timedelta(days=30*months)
-        
-        results = session.query(
-            func.strftime("%Y-%m", Transaction.date).label('month'),
-            Transaction.type,
-            func.sum(Transaction.amount).label('total_amount')
-        ).filter(
-            Transaction.date >= start_date,
-            Transaction.is_void == False
-        ).group_by('month', Transaction.type).all()
+        rows = session.execute(DASHBOARD_SQL, {
+            'start_date': start_date.isoformat(),
+            'income': TransactionType.INCOME.value,
+            'expense': TransactionType.EXPENSE.value,
+            'transfer_pattern': '%Transfer%',
+        }).all()
 
-        df = pd.DataFrame(results, columns=['month', 'type', 'total_amount'])
-        
-        if not df.empty:
-            df_pivot = df.pivot(index='month', columns='type', values='total_amount').fillna(0)
-            for t in [TransactionType.INCOME.value, TransactionType.EXPENSE.value]:
-                if t not in df_pivot.columns:
-                    df_pivot[t] = 0.0
-            return df_pivot
-        else:
-            return pd.DataFrame(columns=['month', TransactionType.INCOME.value, TransactionType.EXPENSE.value])
-    finally:
-        session.close()
+    df = pd.DataFrame(rows, columns=['scope', 'label', 'income', 'expense'])
+    groups = {scope: group for scope, group in df.groupby('scope')}
+    empty = df.iloc[0:0]
 
-def get_income_by_counterparty():
-    """Gets data for the Income Sources pie chart."""
-    session = get_db_session()
-    try:
-        results = session.query(
-            Transaction.counterparty,
-            func.sum(Transaction.amount).label('total_income')
-        ).filter(
-            Transaction.type == TransactionType.INCOME.value,
-            Transaction.is_void == False,
-            Transaction.counterparty.isnot(None),
-            Transaction.counterparty != ''
-        ).group_by(Transaction.counterparty).all()
-        
-        return pd.DataFrame(results, columns=['counterparty', 'total_income'])
-    finally:
-        session.close()
+    # Account balances: the running totals kept in account_balances
+    balance_rows = groups.get('balance', empty)
+    balances = {
+        int(account_id): float(balance)
+        for account_id, balance in zip(balance_rows['label'], balance_rows['income'] - balance_rows['expense'])
+    }
 
-def get_expenses_by_category():
-    """Gets data for the Expenses pie chart."""
-    session = get_db_session()
-    try:
-        results = session.query(
-            Category.name,
-            func.sum(Transaction.amount).label('total_expense')
-        ).join(Transaction.category).filter(
-            Transaction.type == TransactionType.EXPENSE.value,
-            Transaction.is_void == False,
-            Category.name.notlike('%Transfer%')
-        ).group_by(Category.name).all()
-        
-        return pd.DataFrame(results, columns=['category', 'total_expense'])
-    finally:
-        session.close()
+    # Profit & loss: one column per transaction type, indexed by month
+    profit_loss_rows = groups.get('profit_loss', empty)
+    if not profit_loss_rows.empty:
+        # Format the YYYYMM buckets back to "YYYY-MM" labels for the chart axis
+        year_month = profit_loss_rows['label'].astype(int)
+        month = (year_month // 100).astype(str) + '-' + (year_month % 100).astype(str).str.zfill(2)
+        profit_loss_df = pd.DataFrame({
+            TransactionType.INCOME.value: profit_loss_rows['income'].to_numpy(dtype=float),
+            TransactionType.EXPENSE.value: profit_loss_rows['expense'].to_numpy(dtype=float),
+        }, index=pd.Index(month, name='month')).sort_index()
+    else:
+        profit_loss_df = pd.DataFrame(columns=['month', TransactionType.INCOME.value, TransactionType.EXPENSE.value])
+
+    income_rows = groups.get('income', empty)
+    income_df = pd.DataFrame({'counterparty': income_rows['label'], 'total_income': income_rows['income']}).reset_index(drop=True)
+
+    expense_rows = groups.get('expense', empty)
+    expenses_df = pd.DataFrame({'category': expense_rows['label'], 'total_expense': expense_rows['expense']}).reset_index(drop=True)
 
-def get_all_categories():
+    return balances, profit_loss_df, income_df, expenses_df
+
+# Accounts and categories only change through init_db, so share one copy across sessions
+@st.cache_resource(show_spinner=False)
+def get_all_categories(_session=None):
     """Returns a list of all categories for dropdowns."""
-    session = get_db_session()
-    try:
+    with session_scope(_session) as session:
         categories = session.query(Category).order_by(Category.name).all()
         return {cat.name: cat.id for cat in categories}
-    finally:
-        session.close()
 
-def get_all_accounts():
+@st.cache_resource(show_spinner=False)
+def get_all_accounts(_session=None):
     """Returns a list of all accounts for dropdowns."""
-    session = get_db_session()
-    try:
+    with session_scope(_session) as session:
         accounts = session.query(Account).order_by(Account.name).all()
         return {f"{acc.name} ({acc.currency_code})": acc.id for acc in accounts}
-    finally:
-        session.close()
 
-def void_transaction(transaction_id):
+@st.cache_data(ttl=3600, show_spinner=False)
+def get_transfer_category_ids(_session=None):
+    """Returns the (in, out) category IDs used for inter-account transfers."""
+    with session_scope(_session) as session:
+        categories = dict(session.query(Category.name, Category.id).filter(
+            Category.name.in_(['Inter-Account Transfer In', 'Inter-Account Transfer Out'])
+        ).all())
+        return categories['Inter-Account Transfer In'], categories['Inter-Account Transfer Out']
+
+def void_transaction(transaction_id, session=None):
     """Soft-deletes a transaction by marking it as void."""
-    session = get_db_session()
-    try:
-        transaction = session.query(Transaction).filter(Transaction.id == transaction_id).first()
-        if transaction:
-            transaction.is_void = True
-            session.commit()
-            st.success("Transaction voided successfully.")
-            st.session_state.force_rerun = True  # Set flag to trigger rerun
-        else:
-            st.error("Transaction not found.")
-    except Exception as e:
-        session.rollback()
-        st.error(f"Error voiding transaction: {e}")
-    finally:
-        session.close()
+    with session_scope(session) as session:
+        try:
+            transaction = session.query(Transaction).filter(Transaction.id == transaction_id).first()
+            if transaction:
+                transaction.is_void = True
+                session.commit()
+                st.cache_data.clear()
+                st.success("Transaction voided successfully.")
+                st.session_state.force_rerun = True  # Set flag to trigger rerun
+            else:
+                st.error("Transaction not found.")
+        except Exception as e:
+            session.rollback()
+            st.error(f"Error voiding transaction: {e}")
 
 # --- Page Functions ---
 def login_page():
@@ -192,10 +181,12 @@ def login_page():
         submit_button = st.form_submit_button("Login")
         
         if submit_button:
-            session = get_db_session()
-            try:
+            with session_scope() as session:
                 user = session.query(User).filter(User.username == username).first()
                 if user and verify_password(user.password_hash, password):
+                    # Upgrade legacy PBKDF2 hashes now that we have the plain password
+                    if needs_rehash(user.password_hash):
+                        user.password_hash = hash_password(password)
                     st.session_state.authenticated = True
                     st.session_state.username = user.username
                     st.session_state.role = user.role
@@ -204,8 +195,6 @@ def login_page():
                     st.session_state.force_rerun = True  # Set flag to trigger rerun
                 else:
                     st.error("Invalid username or password.")
-            finally:
-                session.close()
 
 def logout():
     """Clears the session state and logs the user out."""
@@ -219,9 +208,11 @@ def dashboard_page():
     """Displays the main dashboard with charts and metrics."""
     st.title("Financial Dashboard")
     
-    usd_balance = get_account_balance(1)
-    inr_balance = get_account_balance(2)
-    latest_rate = get_latest_exchange_rate()
+    with session_scope() as session:
+        balances, profit_loss_df, income_df, expenses_df = get_dashboard_data(_session=session)
+        latest_rate = get_latest_exchange_rate(session)
+    usd_balance = balances.get(1, 0.0)
+    inr_balance = balances.get(2, 0.0)
     total_combined_usd = usd_balance + (inr_balance / latest_rate)
     
     col1, col2, col3, col4 = st.columns(4)
@@ -234,10 +225,6 @@ def dashboard_page():
     with col4:
         st.metric("USD/INR Rate", f"{latest_rate:.2f}")
     
-    profit_loss_df = get_profit_loss_data()
-    income_df = get_income_by_counterparty()
-    expenses_df = get_expenses_by_category()
-    
     col1, col2 = st.columns(2)
     
     with col1:
@@ -256,9 +243,9 @@ def dashboard_page():
     with col2:
         st.subheader("Cash Flow")
         if not profit_loss_df.empty:
-            profit_loss_df['net_cashflow'] = profit_loss_df[TransactionType.INCOME.value] - profit_loss_df[TransactionType.EXPENSE.value]
-            fig = go.Figure(go.Bar(x=profit_loss_df.index, y=profit_loss_df['net_cashflow'],
-                                  marker_color=profit_loss_df['net_cashflow'].apply(lambda x: 'green' if x >= 0 else 'red')))
+            net_cashflow = profit_loss_df[TransactionType.INCOME.value].to_numpy() - profit_loss_df[TransactionType.EXPENSE.value].to_numpy()
+            fig = go.Figure(go.Bar(x=profit_loss_df.index, y=net_cashflow,
+                                  marker_color=np.where(net_cashflow >= 0, 'green', 'red')))
             fig.update_layout(xaxis_title='Month', yaxis_title='Net Cash Flow')
             st.plotly_chart(fig, use_container_width=True)
         else:
@@ -288,22 +275,35 @@ def view_transactions_page():
     """Displays a filterable table of all transactions with edit/delete options."""
     st.title("View All Transactions")
     
-    session = get_db_session()
-    try:
+    with session_scope() as session:
         # Get filter options
-        accounts = get_all_accounts()
-        categories = get_all_categories()
+        accounts = get_all_accounts(session)
+        categories = get_all_categories(session)
         
-        col1, col2, col3 = st.columns(3)
+        col1, col2, col3, col4 = st.columns(4)
         with col1:
             filter_account = st.selectbox("Filter by Account", ["All"] + list(accounts.keys()))
         with col2:
             filter_category = st.selectbox("Filter by Category", ["All"] + list(categories.keys()))
         with col3:
             filter_voided = st.selectbox("Show Voided", ["No", "Yes"])
+        with col4:
+            page = st.number_input("Page", min_value=1, step=1)
         
-        # Build query
-        query = session.query(Transaction).join(Transaction.account).join(Transaction.category)
+        # Build query, selecting only the columns the table shows. Account and category
+        # names come from the joins, so the page is one SELECT with no per-row lazy loads.
+        query = select(
+            Transaction.id,
+            Transaction.date,
+            type_coerce(Transaction.type, String).label('type'),
+            Account.name.label('account_name'),
+            Account.currency_code,
+            Transaction.amount,
+            Category.name.label('category_name'),
+            Transaction.counterparty,
+            Transaction.description,
+            Transaction.is_void
+        ).join(Transaction.account).join(Transaction.category)
         
         if filter_account != "All":
             query = query.filter(Transaction.account_id == accounts[filter_account])
@@ -312,25 +312,25 @@ def view_transactions_page():
         if filter_voided == "No":
             query = query.filter(Transaction.is_void == False)
         
-        transactions = query.order_by(Transaction.date.desc()).all()
+        query = query.order_by(Transaction.date.desc(), Transaction.id.desc())
+        query = query.limit(TRANSACTIONS_PAGE_SIZE).offset((page - 1) * TRANSACTIONS_PAGE_SIZE)
         
-        # Display transactions in a dataframe
-        transaction_data = []
-        for t in transactions:
-            transaction_data.append({
-                "ID": t.id,
-                "Date": t.date,
-                "Type": t.type.value,
-                "Account": f"{t.account.name} ({t.account.currency_code})",
-                "Amount": t.amount,
-                "Category": t.category.name,
-                "Counterparty": t.counterparty,
-                "Description": t.description,
-                "Voided": "Yes" if t.is_void else "No"
-            })
+        # Load the page straight into columns instead of building ORM objects row by row
+        df = pd.read_sql_query(query, session.connection(), dtype={'id': 'int64', 'amount': 'float64', 'is_void': 'bool'})
         
-        if transaction_data:
-            df = pd.DataFrame(transaction_data)
+        if not df.empty:
+            df['Account'] = df['account_name'] + ' (' + df['currency_code'] + ')'
+            df['Voided'] = np.where(df['is_void'], 'Yes', 'No')
+            df = df.rename(columns={
+                'id': 'ID',
+                'date': 'Date',
+                'type': 'Type',
+                'amount': 'Amount',
+                'category_name': 'Category',
+                'counterparty': 'Counterparty',
+                'description': 'Description'
+            })
+            df = df[['ID', 'Date', 'Type', 'Account', 'Amount', 'Category', 'Counterparty', 'Description', 'Voided']]
             st.dataframe(df, use_container_width=True, hide_index=True)
             
             # Edit/Delete options for admins
@@ -341,7 +341,7 @@ def view_transactions_page():
                 with col1:
                     if st.button("Void Transaction", type="secondary"):
                         if st.session_state.role == 'admin':
-                            void_transaction(selected_id)
+                            void_transaction(selected_id, session)
                         else:
                             st.error("Insufficient permissions.")
                 with col2:
@@ -349,135 +349,131 @@ def view_transactions_page():
                         st.info("Edit feature coming soon.")
         else:
             st.info("No transactions found matching your filters.")
-            
-    finally:
-        session.close()
 
 def add_transaction_page():
     """Form to add a new income or expense transaction."""
     st.title("Add New Transaction")
     
-    accounts = get_all_accounts()
-    categories = get_all_categories()
-    
-    with st.form("add_transaction_form", clear_on_submit=True):
-        col1, col2 = st.columns(2)
-        with col1:
-            trans_date = st.date_input("Date", value=date.today())
-            trans_type = st.radio("Type", [TransactionType.INCOME.value, TransactionType.EXPENSE.value])
-            account_name = st.selectbox("Account", options=list(accounts.keys()))
-            amount = st.number_input("Amount", min_value=0.0, format="%.2f")
-        with col2:
-            category_name = st.selectbox("Category", options=list(categories.keys()))
-            counterparty = st.text_input("Counterparty (Who is this from/to?)")
-            description = st.text_area("Description")
-        
-        # Split transaction feature
-        with st.expander("Split this transaction (optional)"):
-            st.warning("Splitting is not yet implemented. Coming soon!")
-        
-        submitted = st.form_submit_button("Add Transaction")
+    with session_scope() as session:
+        accounts = get_all_accounts(session)
+        categories = get_all_categories(session)
         
-        if submitted:
-            session = get_db_session()
-            try:
-                new_transaction = Transaction(
-                    date=trans_date,
-                    type=trans_type,
-                    amount=amount,
-                    description=description,
-                    counterparty=counterparty,
-                    account_id=accounts[account_name],
-                    category_id=categories[category_name],
-                    is_void=False
-                )
-                session.add(new_transaction)
-                session.commit()
-                st.success("Transaction added successfully!")
-            except Exception as e:
-                session.rollback()
-                st.error(f"Error adding transaction: {e}")
-            finally:
-                session.close()
+        with st.form("add_transaction_form", clear_on_submit=True):
+            col1, col2 = st.columns(2)
+            with col1:
+                trans_date = st.date_input("Date", value=date.today())
+                trans_type = st.radio("Type", [TransactionType.INCOME.value, TransactionType.EXPENSE.value])
+                account_name = st.selectbox("Account", options=list(accounts.keys()))
+                amount = st.number_input("Amount", min_value=0.0, format="%.2f")
+            with col2:
+                category_name = st.selectbox("Category", options=list(categories.keys()))
+                counterparty = st.text_input("Counterparty (Who is this from/to?)")
+                description = st.text_area("Description")
+            
+            # Split transaction feature
+            with st.expander("Split this transaction (optional)"):
+                st.warning("Splitting is not yet implemented. Coming soon!")
+            
+            submitted = st.form_submit_button("Add Transaction")
+            
+            if submitted:
+                try:
+                    new_transaction = Transaction(
+                        date=trans_date,
+                        type=TransactionType(trans_type),
+                        amount=amount,
+                        description=description,
+                        counterparty=counterparty,
+                        account_id=accounts[account_name],
+                        category_id=categories[category_name],
+                        is_void=False
+                    )
+                    session.add(new_transaction)
+                    session.commit()
+                    st.cache_data.clear()
+                    st.success("Transaction added successfully!")
+                except Exception as e:
+                    session.rollback()
+                    st.error(f"Error adding transaction: {e}")
 
 def transfer_funds_page():
     """Form to transfer money between USD and INR accounts."""
     st.title("Transfer Funds Between Accounts")
     
-    accounts = get_all_accounts()
-    latest_rate = get_latest_exchange_rate()
-    st.info(f"Current USD/INR Rate: **1 USD = {latest_rate:.2f} INR**")
-    
-    with st.form("transfer_funds_form"):
-        col1, col2 = st.columns(2)
-        with col1:
-            trans_date = st.date_input("Date", value=date.today())
-            from_account_name = st.selectbox("From Account", options=list(accounts.keys()), index=0)
-        with col2:
-            amount = st.number_input("Amount to Transfer", min_value=0.01, format="%.2f")
-            to_account_name = st.selectbox("To Account", options=list(accounts.keys()), index=1)
+    with session_scope() as session:
+        accounts = get_all_accounts(session)
+        latest_rate = get_latest_exchange_rate(session)
+        st.info(f"Current USD/INR Rate: **1 USD = {latest_rate:.2f} INR**")
         
-        # Calculate estimated conversion
-        if from_account_name != to_account_name:
-            from_acc_id = accounts[from_account_name]
-            to_acc_id = accounts[to_account_name]
+        with st.form("transfer_funds_form"):
+            col1, col2 = st.columns(2)
+            with col1:
+                trans_date = st.date_input("Date", value=date.today())
+                from_account_name = st.selectbox("From Account", options=list(accounts.keys()), index=0)
+            with col2:
+                amount = st.number_input("Amount to Transfer", min_value=0.01, format="%.2f")
+                to_account_name = st.selectbox("To Account", options=list(accounts.keys()), index=1)
             
-            # Simple logic for demo: Assume first account is USD, second is INR
-            if "USD" in from_account_name and "INR" in to_account_name:
-                converted_amount = amount * latest_rate
-                st.write(f"**{amount:,.2f} USD** will be converted to **₹{converted_amount:,.2f} INR**")
-            elif "INR" in from_account_name and "USD" in to_account_name:
-                converted_amount = amount / latest_rate
-                st.write(f"**₹{amount:,.2f} INR** will be converted to **${converted_amount:,.2f} USD**")
-            else:
-                st.warning("Please select different accounts for transfer.")
-        else:
-            st.error("Cannot transfer between the same account.")
-        
-        description = st.text_input("Description", value="Inter-Account Transfer")
-        
-        submitted = st.form_submit_button("Execute Transfer")
-        
-        if submitted and from_account_name != to_account_name:
-            session = get_db_session()
-            try:
-                # Create withdrawal transaction
-                withdrawal = Transaction(
-                    date=trans_date,
-                    type=TransactionType.EXPENSE.value,
-                    amount=amount,
-                    description=description,
-                    counterparty="Internal Transfer",
-                    account_id=from_acc_id,
-                    category_id=get_all_categories()["Inter-Account Transfer Out"],
-                    exchange_rate=latest_rate,
-                    is_void=False
-                )
+            # Calculate estimated conversion
+            if from_account_name != to_account_name:
+                from_acc_id = accounts[from_account_name]
+                to_acc_id = accounts[to_account_name]
                 
-                # Create deposit transaction
-                deposit_amount = amount * latest_rate if "USD" in from_account_name else amount / latest_rate
-                deposit = Transaction(
-                    date=trans_date,
-                    type=TransactionType.INCOME.value,
-                    amount=deposit_amount,
-                    description=description,
-                    counterparty="Internal Transfer",
-                    account_id=to_acc_id,
-                    category_id=get_all_categories()["Inter-Account Transfer In"],
-                    exchange_rate=latest_rate,
-                    is_void=False
-                )
-                
-                session.add(withdrawal)
-                session.add(deposit)
-                session.commit()
-                st.success("Funds transferred successfully!")
-                
-            except Exception as e:
-                session.rollback()
-                st.error(f"Error transferring funds: {e}")
-            finally:
-                session.close()
+                # Simple logic for demo: Assume first account is USD, second is INR
+                if "USD" in from_account_name and "INR" in to_account_name:
+                    converted_amount = amount * latest_rate
+                    st.write(f"**{amount:,.2f} USD** will be converted to **₹{converted_amount:,.2f} INR**")
+                elif "INR" in from_account_name and "USD" in to_account_name:
+                    converted_amount = amount / latest_rate
+                    st.write(f"**₹{amount:,.2f} INR** will be converted to **${converted_amount:,.2f} USD**")
+                else:
+                    st.warning("Please select different accounts for transfer.")
+            else:
+                st.error("Cannot transfer between the same account.")
+            
+            description = st.text_input("Description", value="Inter-Account Transfer")
+            
+            submitted = st.form_submit_button("Execute Transfer")
+            
+            if submitted and from_account_name != to_account_name:
+                try:
+                    transfer_in_id, transfer_out_id = get_transfer_category_ids(session)
+
+                    # Withdrawal from the source account
+                    withdrawal = dict(
+                        date=trans_date,
+                        type=TransactionType.EXPENSE,
+                        amount=round_amount(amount),
+                        description=description,
+                        counterparty="Internal Transfer",
+                        account_id=from_acc_id,
+                        category_id=transfer_out_id,
+                        exchange_rate=latest_rate
+                    )
+                    
+                    # Deposit into the destination account
+                    deposit_amount = amount * latest_rate if "USD" in from_account_name else amount / latest_rate
+                    deposit_amount = round_amount(deposit_amount)
+                    deposit = dict(
+                        withdrawal,
+                        type=TransactionType.INCOME,
+                        amount=deposit_amount,
+                        account_id=to_acc_id,
+                        category_id=transfer_in_id
+                    )
+                    
+                    # Insert both rows with Core, skipping the ORM unit of work. The withdrawal
+                    # goes first so the deposit can link back to it through transfer_id.
+                    insert = Transaction.__table__.insert()
+                    withdrawal_id = session.execute(insert.returning(Transaction.__table__.c.id), withdrawal).scalar_one()
+                    session.execute(insert, dict(deposit, transfer_id=withdrawal_id))
+                    session.commit()
+                    st.cache_data.clear()
+                    st.success("Funds transferred successfully!")
+                    
+                except Exception as e:
+                    session.rollback()
+                    st.error(f"Error transferring funds: {e}")
 
 def reports_page():
     """Placeholder for the reports page."""
@@ -517,18 +513,37 @@ def main_app():
         logout()
 
 # --- Main Application Logic ---
+@st.cache_resource(ttl=86400, show_spinner=False)
+def init_db_once():
+    """
+    Runs init_db once per process instead of on every rerun. The daily TTL
+    lets long-running servers re-check for a new day's exchange rate.
+    """
+    if not init_db():
+        # Raising keeps the failed run out of the cache, so the next rerun tries again
+        raise RuntimeError("Database initialization failed")
+
 def main():
-    init_db()
+    try:
+        init_db_once()
+    except RuntimeError:
+        st.warning("Database setup didn't complete; it will be retried on the next page load.")
     
     # Check if we need to rerun due to state changes (login/logout)
     if st.session_state.get('force_rerun', False):
         st.session_state.force_rerun = False
+        close_db()
         st.rerun()
     
-    if not st.session_state.authenticated:
-        login_page()
-    else:
-        main_app()
+    # Streamlit reuses the script thread across reruns, so release its scoped
+    # session after each run rather than letting its identity map carry over
+    try:
+        if not st.session_state.authenticated:
+            login_page()
+        else:
+            main_app()
+    finally:
+        close_db()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,12 +1,16 @@
 # database.py
-from sqlalchemy import create_engine, text
+from sqlalchemy import create_engine, event, inspect, text
 from sqlalchemy.orm import scoped_session, sessionmaker
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.schema import CreateTable
 import os
-from models import Base, User, Account, Category, TransactionType
-from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
-from cryptography.hazmat.backends import default_backend
+from contextlib import contextmanager
+from models import Base, User, Account, Category, Transaction, TransactionSplit, ExchangeRate, TransactionType, SIGNED_AMOUNT_SQL
+from datetime import date
+import requests
+import threading
+import hashlib
+import hmac
 import base64
 import secrets
 
@@ -21,11 +25,38 @@ database_path = os.path.join(instance_path, 'app.db')
 database_url = f'sqlite:///{database_path}'
 
 # --- Create the SQLAlchemy engine and session factory ---
+def make_engine(url):
+    """
+    Creates the engine with an explicitly sized connection pool, so several
+    browser sessions can hold connections at once without waiting on each other.
+    """
+    return create_engine(
+        url,
+        connect_args={"check_same_thread": False},
+        pool_size=10,
+        max_overflow=20,
+        pool_timeout=30
+    )
+
 # The engine is the entry point to the database
-engine = create_engine(database_url, connect_args={"check_same_thread": False})
+engine = make_engine(database_url)
 
-# SessionFactory: a factory for creating new Session objects
-SessionFactory = sessionmaker(bind=engine, autoflush=False, autocommit=False)
+# Tune every new SQLite connection: WAL lets readers run alongside a writer,
+# and synchronous=NORMAL skips the extra fsync per commit that WAL doesn't need.
+# SQLite only enforces foreign keys (and their ON DELETE CASCADE) when asked to.
+@event.listens_for(engine, "connect")
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    dbapi_connection.execute("PRAGMA journal_mode=WAL")
+    dbapi_connection.execute("PRAGMA synchronous=NORMAL")
+    dbapi_connection.execute("PRAGMA temp_store=MEMORY")
+    dbapi_connection.execute("PRAGMA mmap_size=268435456")
+    dbapi_connection.execute("PRAGMA cache_size=-20000")
+    dbapi_connection.execute("PRAGMA foreign_keys=ON")
+
+# SessionFactory: a factory for creating new Session objects.
+# Objects keep their loaded state after a commit instead of re-selecting on the next
+# attribute access; call session.expire(obj) where a fresh read is actually needed.
+SessionFactory = sessionmaker(bind=engine, autoflush=False, autocommit=False, expire_on_commit=False)
 
 # ScopedSession: ensures a unique session per thread (important for web apps)
 db_session = scoped_session(SessionFactory)
@@ -35,42 +66,44 @@ db_session = scoped_session(SessionFactory)
 def generate_salt():
     return secrets.token_bytes(16)
 
+# Hashes derived with scrypt carry this prefix; hashes without it are legacy PBKDF2
+SCRYPT_PREFIX = 'scrypt$'
+
 # Password hashing function
 def hash_password(password, salt=None):
     if salt is None:
         salt = generate_salt()
-    kdf = PBKDF2HMAC(
-        algorithm=hashes.SHA256(),
-        length=32,
-        salt=salt,
-        iterations=100000,
-        backend=default_backend()
-    )
-    key = kdf.derive(password.encode())
+    key = hashlib.scrypt(password.encode(), salt=salt, n=2**14, r=8, p=1, dklen=32)
     # Store the salt and the key together in a single string
-    stored = base64.b64encode(salt + key).decode('utf-8')
+    stored = SCRYPT_PREFIX + base64.b64encode(salt + key).decode('utf-8')
     return stored
 
 # Password verification function
 def verify_password(stored_hash, provided_password):
     """Verify a provided password against a stored hash."""
     try:
+        is_scrypt = stored_hash.startswith(SCRYPT_PREFIX)
+        if is_scrypt:
+            stored_hash = stored_hash[len(SCRYPT_PREFIX):]
+
         decoded = base64.b64decode(stored_hash)
         salt_from_db = decoded[:16] # First 16 bytes are the salt
         key_from_db = decoded[16:]  # The rest is the derived key
 
-        kdf = PBKDF2HMAC(
-            algorithm=hashes.SHA256(),
-            length=32,
-            salt=salt_from_db,
-            iterations=100000,
-            backend=default_backend()
-        )
-        new_key = kdf.derive(provided_password.encode())
-        return new_key == key_from_db
+        if is_scrypt:
+            new_key = hashlib.scrypt(provided_password.encode(), salt=salt_from_db, n=2**14, r=8, p=1, dklen=32)
+        else:
+            new_key = hashlib.pbkdf2_hmac('sha256', provided_password.encode(), salt_from_db, 100000, dklen=32)
+        # Constant-time comparison so timing does not leak how much of the key matched
+        return hmac.compare_digest(new_key, key_from_db)
     except Exception:
         return False
 
+# Check whether a stored hash should be upgraded to the current format
+def needs_rehash(stored_hash):
+    """Returns True for hashes still in the legacy PBKDF2 format."""
+    return not stored_hash.startswith(SCRYPT_PREFIX)
+
 def fix_enum_data(session):
     """Fix enum values in the database if they're lowercase"""
     try:
@@ -86,15 +119,197 @@ def fix_enum_data(session):
             session.execute(text("UPDATE transactions SET type = 'EXPENSE' WHERE type = 'expense'"))
             session.commit()
             print("Database enum values fixed!")
+        return True
     except Exception as e:
         print(f"Error fixing enum data: {e}")
         session.rollback()
+        return False
+
+def add_year_month_column(session):
+    """Add and backfill the year_month column on databases created before it existed"""
+    try:
+        columns = [column['name'] for column in inspect(engine).get_columns('transactions')]
+        if 'year_month' not in columns:
+            session.execute(text("ALTER TABLE transactions ADD COLUMN year_month INTEGER"))
+            print("Added year_month column to transactions.")
+
+        session.execute(text(
+            "UPDATE transactions "
+            "SET year_month = CAST(strftime('%Y', date) AS INTEGER) * 100 + CAST(strftime('%m', date) AS INTEGER) "
+            "WHERE year_month IS NULL"
+        ))
+        session.commit()
+        return True
+    except Exception as e:
+        print(f"Error adding year_month column: {e}")
+        session.rollback()
+        return False
+
+def add_signed_amount_column(session):
+    """Add the generated signed_amount column on databases created before it existed"""
+    try:
+        columns = [column['name'] for column in inspect(engine).get_columns('transactions')]
+        if 'signed_amount' not in columns:
+            # SQLite can only add VIRTUAL generated columns to an existing table
+            session.execute(text(
+                "ALTER TABLE transactions ADD COLUMN signed_amount NUMERIC(18, 2) "
+                f"GENERATED ALWAYS AS ({SIGNED_AMOUNT_SQL}) VIRTUAL"
+            ))
+            session.commit()
+            print("Added signed_amount column to transactions.")
+        return True
+    except Exception as e:
+        print(f"Error adding signed_amount column: {e}")
+        session.rollback()
+        return False
+
+def round_stored_amounts(session):
+    """Round amounts stored before writes were rounded to cents"""
+    try:
+        for table in ('transactions', 'transaction_splits'):
+            result = session.execute(text(
+                f"UPDATE {table} SET amount = ROUND(amount, 2) WHERE amount != ROUND(amount, 2)"
+            ))
+            if result.rowcount:
+                print(f"Rounded {result.rowcount} {table} amounts to cents.")
+        session.commit()
+        return True
+    except Exception as e:
+        print(f"Error rounding stored amounts: {e}")
+        session.rollback()
+        return False
+
+def add_split_delete_cascade():
+    """Rebuild transaction_splits on databases created before its foreign key cascaded deletes"""
+    foreign_keys = inspect(engine).get_foreign_keys('transaction_splits')
+    if any(fk['referred_table'] == 'transactions' and fk['options'].get('ondelete', '').upper() == 'CASCADE'
+           for fk in foreign_keys):
+        return True
+
+    # SQLite can't alter a foreign key, so copy the rows into a freshly created table.
+    # Keys are switched off for the copy as SQLite's ALTER TABLE docs require.
+    columns = ', '.join(column.name for column in TransactionSplit.__table__.columns)
+    connection = engine.raw_connection()
+    try:
+        dbapi_connection = connection.driver_connection
+        try:
+            dbapi_connection.executescript(f"""
+                PRAGMA foreign_keys=OFF;
+                BEGIN;
+                ALTER TABLE transaction_splits RENAME TO transaction_splits_old;
+                {CreateTable(TransactionSplit.__table__).compile(engine)};
+                INSERT INTO transaction_splits ({columns}) SELECT {columns} FROM transaction_splits_old;
+                DROP TABLE transaction_splits_old;
+                COMMIT;
+            """)
+            print("Rebuilt transaction_splits with ON DELETE CASCADE.")
+            return True
+        except Exception as e:
+            print(f"Error rebuilding transaction_splits: {e}")
+            if dbapi_connection.in_transaction:
+                dbapi_connection.rollback()
+            return False
+        finally:
+            dbapi_connection.execute("PRAGMA foreign_keys=ON")
+    finally:
+        connection.close()
+
+# --- Exchange Rate Functions ---
+def fetch_and_store_exchange_rate():
+    """Fetches the current USD/INR rate from Frankfurter.app and stores it in the DB."""
+    try:
+        response = requests.get("https://api.frankfurter.app/latest?from=USD&to=INR", timeout=10)
+        response.raise_for_status()
+        current_rate = response.json()['rates']['INR']
+
+        with session_scope() as session:
+            today = date.today()
+            existing_rate = session.query(ExchangeRate).filter(ExchangeRate.date == today).first()
+            if not existing_rate:
+                session.add(ExchangeRate(date=today, usd_to_inr=current_rate))
+            else:
+                existing_rate.usd_to_inr = current_rate
+        print(f"Fetched and stored new exchange rate: 1 USD = {current_rate} INR")
+        return current_rate
+    except requests.RequestException as e:
+        print(f"Failed to fetch exchange rate: {e}")
+    except Exception as e:
+        print(f"Error storing exchange rate: {e}")
+    return None
+
+def refresh_exchange_rate(session):
+    """Starts a background fetch of today's exchange rate unless it is already stored."""
+    latest_rate = session.query(ExchangeRate).order_by(ExchangeRate.date.desc()).first()
+    if latest_rate is None or latest_rate.date < date.today():
+        # Run off the page-load path so a slow or unreachable API never blocks the UI
+        threading.Thread(target=fetch_and_store_exchange_rate, daemon=True).start()
+
+# --- Indexes for the reporting queries ---
+# Partial indexes only cover non-voided rows, which is all the aggregates read
+TRANSACTION_INDEXES = [
+    # Dashboard profit & loss: the date range of the last few months
+    "CREATE INDEX IF NOT EXISTS ix_tx_active_date ON transactions(date, type) WHERE is_void = 0",
+    # Dashboard expenses by category
+    "CREATE INDEX IF NOT EXISTS ix_tx_active_cat ON transactions(category_id) WHERE is_void = 0 AND type = 'EXPENSE'",
+    # Dashboard income by counterparty
+    "CREATE INDEX IF NOT EXISTS ix_tx_active_cp ON transactions(counterparty) WHERE is_void = 0 AND type = 'INCOME'",
+    # Transaction list filtered to one account, newest first
+    "CREATE INDEX IF NOT EXISTS ix_tx_account_date ON transactions(account_id, date DESC)",
+]
+
+# --- Account balance triggers ---
+# Keep account_balances in step with every write to transactions, adding a row's
+# signed cents on insert and taking them back out on delete.
+def _signed_cents_sql(row):
+    return f"CAST(ROUND({row}.signed_amount * 100) AS INTEGER)"
+
+ACCOUNT_BALANCE_TRIGGERS = [
+    f"""
+    CREATE TRIGGER IF NOT EXISTS trg_account_balance_insert AFTER INSERT ON transactions
+    WHEN NEW.is_void = 0
+    BEGIN
+        INSERT OR IGNORE INTO account_balances (account_id, balance_cents) VALUES (NEW.account_id, 0);
+        UPDATE account_balances SET balance_cents = balance_cents + {_signed_cents_sql('NEW')}
+        WHERE account_id = NEW.account_id;
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS trg_account_balance_update
+    AFTER UPDATE OF amount, type, is_void, account_id ON transactions
+    BEGIN
+        UPDATE account_balances SET balance_cents = balance_cents - {_signed_cents_sql('OLD')}
+        WHERE account_id = OLD.account_id AND OLD.is_void = 0;
+        INSERT OR IGNORE INTO account_balances (account_id, balance_cents)
+        SELECT NEW.account_id, 0 WHERE NEW.is_void = 0;
+        UPDATE account_balances SET balance_cents = balance_cents + {_signed_cents_sql('NEW')}
+        WHERE account_id = NEW.account_id AND NEW.is_void = 0;
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS trg_account_balance_delete AFTER DELETE ON transactions
+    WHEN OLD.is_void = 0
+    BEGIN
+        UPDATE account_balances SET balance_cents = balance_cents - {_signed_cents_sql('OLD')}
+        WHERE account_id = OLD.account_id;
+    END
+    """,
+]
+
+def rebuild_account_balances(connection):
+    """Recomputes account_balances from scratch, e.g. for rows written before the triggers existed."""
+    connection.execute(text("DELETE FROM account_balances"))
+    connection.execute(text(
+        "INSERT INTO account_balances (account_id, balance_cents) "
+        f"SELECT account_id, SUM({_signed_cents_sql('transactions')}) "
+        "FROM transactions WHERE is_void = 0 GROUP BY account_id"
+    ))
 
 # --- Database Initialization Function ---
 def init_db():
     """
     Creates all database tables and populates them with initial data.
     This function should be called once when the application is first set up.
+    Returns True if every step succeeded, so callers know whether to retry.
     """
     # Import models to ensure they are registered with Base.metadata
     from models import Base, User, Account, Category
@@ -106,21 +321,40 @@ def init_db():
     session = db_session()
 
     try:
-        # Fix any existing enum data issues first
-        fix_enum_data(session)
+        # Fix any existing enum data issues first. Every migration runs even if an
+        # earlier one failed; they're all safe to repeat on the next attempt.
+        migrated = all([
+            fix_enum_data(session),
+            add_year_month_column(session),
+            add_signed_amount_column(session),
+            round_stored_amounts(session),
+            add_split_delete_cascade(),
+        ])
+
+        # Create indexes matching the dashboard and transaction list filters
+        with engine.begin() as connection:
+            for index in Transaction.__table__.indexes:
+                index.create(bind=connection, checkfirst=True)
+            for statement in TRANSACTION_INDEXES:
+                connection.execute(text(statement))
+
+            for statement in ACCOUNT_BALANCE_TRIGGERS:
+                connection.execute(text(statement))
+            rebuild_account_balances(connection)
 
         # --- 1. Create Default Accounts ---
-        usd_account = session.query(Account).filter_by(currency_code='USD').first()
-        inr_account = session.query(Account).filter_by(currency_code='INR').first()
+        # One query for the currencies that already have an account
+        existing_currencies = {
+            row.currency_code for row in
+            session.query(Account.currency_code).filter(Account.currency_code.in_(['USD', 'INR'])).all()
+        }
 
-        if not usd_account:
-            usd_account = Account(name="US Business Account", currency_code="USD")
-            session.add(usd_account)
+        if 'USD' not in existing_currencies:
+            session.add(Account(name="US Business Account", currency_code="USD"))
             print("Created USD Account.")
 
-        if not inr_account:
-            inr_account = Account(name="India Business Account", currency_code="INR")
-            session.add(inr_account)
+        if 'INR' not in existing_currencies:
+            session.add(Account(name="India Business Account", currency_code="INR"))
             print("Created INR Account.")
 
         # --- 2. Create Default Categories ---
@@ -137,35 +371,36 @@ def init_db():
             "Other Expense"
         ]
 
-        for cat_name in default_categories:
-            category = session.query(Category).filter_by(name=cat_name).first()
-            if not category:
-                category = Category(name=cat_name)
-                session.add(category)
-        print("Created default categories.")
+        existing_categories = {
+            row.name for row in
+            session.query(Category.name).filter(Category.name.in_(default_categories)).all()
+        }
+        missing_categories = [Category(name=cat_name) for cat_name in default_categories if cat_name not in existing_categories]
+        if missing_categories:
+            session.add_all(missing_categories)
+            print("Created default categories.")
 
         # --- 3. Create Default Users (Admin & Viewer) ---
         # Check if users already exist first
-        admin_user = session.query(User).filter_by(username='admin').first()
-        viewer_user = session.query(User).filter_by(username='viewer').first()
+        existing_users = {
+            row.username for row in
+            session.query(User.username).filter(User.username.in_(['admin', 'viewer'])).all()
+        }
 
-        # Hash the passwords
-        admin_password_hash = hash_password("admin123")
-        viewer_password_hash = hash_password("view123")
-
-        if not admin_user:
+        # Only hash the default passwords for users that still need creating
+        if 'admin' not in existing_users:
             admin_user = User(
                 username='admin',
-                password_hash=admin_password_hash,
+                password_hash=hash_password("admin123"),
                 role='admin'
             )
             session.add(admin_user)
             print("Created admin user.")
 
-        if not viewer_user:
+        if 'viewer' not in existing_users:
             viewer_user = User(
                 username='viewer',
-                password_hash=viewer_password_hash,
+                password_hash=hash_password("view123"),
                 role='viewer'
             )
             session.add(viewer_user)
@@ -175,6 +410,10 @@ def init_db():
         session.commit()
         print("Database initialized successfully.")
 
+        # --- 4. Refresh the exchange rate at most once a day ---
+        refresh_exchange_rate(session)
+        return migrated
+
     except IntegrityError as e:
         session.rollback()
         print(f"An error occurred during initialization: {e}")
@@ -183,12 +422,35 @@ def init_db():
         print(f"An unexpected error occurred: {e}")
     finally:
         session.close()
+    return False
 
 # Function to get a new database session
 def get_db_session():
     """Provides a new database session from the scoped session."""
     return db_session()
 
+# Context manager for a request-scoped session
+@contextmanager
+def session_scope(session=None):
+    """
+    Provides a transactional scope around a series of operations.
+    If an existing session is passed in it is reused as-is, and committing
+    and cleaning it up is left to the scope that opened it.
+    """
+    if session is not None:
+        yield session
+        return
+
+    session = db_session()
+    try:
+        yield session
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        db_session.remove()
+
 # Function to close the database session
 def close_db(e=None):
     """Closes the current database session. Important for cleaning up."""
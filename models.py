@@ -1,8 +1,12 @@
 # models.py
-from sqlalchemy import create_engine, Column, Integer, String, Float, Date, Boolean, ForeignKey, Enum
-from sqlalchemy.orm import declarative_base, relationship, sessionmaker, scoped_session
+from sqlalchemy import create_engine, TypeDecorator, Column, Integer, String, Numeric, Date, Boolean, ForeignKey, Enum, Index, CheckConstraint, Computed, select, func, cast, event
+from sqlalchemy.orm import declarative_base, relationship, sessionmaker, scoped_session, selectinload, object_session, validates
+from sqlalchemy.orm.util import identity_key
 from sqlalchemy.ext.hybrid import hybrid_property
 from datetime import date
+from decimal import Decimal, ROUND_HALF_UP
+from contextlib import contextmanager
+from contextvars import ContextVar
 import enum
 import os
 
@@ -12,11 +16,30 @@ Base = declarative_base()
 # --- Database Engine Setup (will be fully configured in database.py) ---
 # The engine URL will be set elsewhere. This is just for the model definitions.
 
+# --- Column Types ---
+class Money(TypeDecorator):
+    """
+    Fixed-point NUMERIC in the schema, read back as a float. SQLite stores whole
+    amounts like 50.0 as integers, so the value is coerced on the way out.
+    """
+    impl = Numeric
+    cache_ok = True
+
+    def process_result_value(self, value, dialect):
+        return None if value is None else float(value)
+
 # --- Enum for Transaction Types ---
 class TransactionType(enum.Enum):
     INCOME = "INCOME"  # Changed to uppercase
     EXPENSE = "EXPENSE"  # Changed to uppercase
 
+# Looked up once here rather than on every row the balance code touches
+_INCOME = TransactionType.INCOME
+_INCOME_VALUE = TransactionType.INCOME.value
+
+# Balances loaded by Account.primed_balances(); Account.balance reads from this while it is set
+_primed_balances = ContextVar('primed_balances', default=None)
+
 # --- Database Models ---
 
 class User(Base):
@@ -43,26 +66,90 @@ class Account(Base):
     def __repr__(self):
         return f'<Account {self.name} ({self.currency_code})>'
 
+    # Collections stay lazy by default so dropdown lookups don't pull every transaction.
+    # Pass these options, as .options(*Account.with_transactions()), when iterating accounts
+    # and their transactions (e.g. for balance) to load all of them with one IN query
+    # instead of one query per account.
+    @classmethod
+    def with_transactions(cls):
+        return (selectinload(cls.transactions),)
+
     # This is a "hybrid property". It can be used in Python and in database queries.
     @hybrid_property
     def balance(self):
+        # Reuse the total from an earlier access; the events at the bottom of this
+        # module drop it whenever one of the account's transactions changes.
+        cached = self.__dict__.get('_balance_cache')
+        if cached is not None:
+            return cached
+        primed = _primed_balances.get()
+        if primed is not None:
+            return primed.get(self.id, 0.0)
+
         # Calculate the balance by summing all non-voided transactions for this account.
-        # This is the Python-side calculation.
-        total = 0.0
-        for transaction in self.transactions:
-            if not transaction.is_void:
-                if transaction.type == TransactionType.INCOME:
-                    total += transaction.amount
-                else: # EXPENSE
-                    total -= transaction.amount
+        # This is the Python-side calculation. Summing whole cents keeps the
+        # accumulator an exact integer instead of compounding float rounding.
+        total_cents = sum(
+            transaction.signed_cents for transaction in self.transactions if not transaction.is_void
+        )
+        total = total_cents / 100
+        self._balance_cache = total
         return total
-    # Note: A more advanced implementation would add a SQL expression for this hybrid.
+
+    @balance.expression
+    def balance(cls):
+        # The SQL-side version: a correlated lookup of the running total kept in
+        # account_balances, so queries like session.query(Account.id, Account.balance)
+        # get every balance in one round-trip without scanning any transactions.
+        balance_cents = (
+            select(AccountBalance.balance_cents)
+            .where(AccountBalance.account_id == cls.id)
+            .scalar_subquery()
+        )
+        return func.coalesce(balance_cents, 0) / 100.0
+
+    @staticmethod
+    def _balance_cents(session, *criteria):
+        return dict(session.execute(
+            select(AccountBalance.account_id, AccountBalance.balance_cents).where(*criteria)
+        ).all())
+
+    @classmethod
+    def balances_bulk(cls, session, account_ids):
+        """Returns {account_id: balance} for the given accounts from one lookup in account_balances."""
+        balance_cents = cls._balance_cents(session, AccountBalance.account_id.in_(account_ids))
+        return {account_id: balance_cents.get(account_id, 0) / 100 for account_id in account_ids}
+
+    @classmethod
+    def balances_all(cls, session):
+        """Returns {account_id: balance} for every account that has transactions."""
+        return {account_id: cents / 100 for account_id, cents in cls._balance_cents(session).items()}
+
+    @classmethod
+    @contextmanager
+    def primed_balances(cls, session):
+        """Loads every balance up front so account.balance inside the block needs no queries."""
+        token = _primed_balances.set(cls.balances_all(session))
+        try:
+            yield
+        finally:
+            _primed_balances.reset(token)
+
+# Running total of each account's non-voided transactions, in cents. SQLite has no
+# materialized views, so database.py keeps this current with triggers on transactions.
+class AccountBalance(Base):
+    __tablename__ = 'account_balances'
+    account_id = Column(Integer, ForeignKey('accounts.id'), primary_key=True)
+    balance_cents = Column(Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f'<AccountBalance {self.account_id}: {self.balance_cents}>'
 
 class ExchangeRate(Base):
     __tablename__ = 'exchange_rates'
     id = Column(Integer, primary_key=True)
     date = Column(Date, default=date.today, nullable=False)
-    usd_to_inr = Column(Float, nullable=False)
+    usd_to_inr = Column(Money(18, 8, asdecimal=False), nullable=False)
 
     def __repr__(self):
         return f'<ExchangeRate {self.date}: 1 USD = {self.usd_to_inr} INR>'
@@ -79,45 +166,203 @@ class Category(Base):
     def __repr__(self):
         return f'<Category {self.name}>'
 
+    # Like Account.with_transactions, for both of the category's collections
+    # (also a tuple, unpacked into .options(*...))
+    @classmethod
+    def with_transactions(cls):
+        return selectinload(cls.transactions), selectinload(cls.split_transactions)
+
+def round_amount(amount):
+    """Rounds a money amount to whole cents (half up), the precision every amount is stored at."""
+    return float(Decimal(str(amount)).quantize(Decimal('0.01'), rounding=ROUND_HALF_UP))
+
+def year_month_of(day):
+    """The YYYYMM bucket a date falls in."""
+    return day.year * 100 + day.month
+
+def _year_month_default(context):
+    """Derives the YYYYMM bucket from the row's date when an insert leaves year_month out."""
+    return year_month_of(context.get_current_parameters().get('date') or date.today())
+
+# SQL for Transaction.signed_amount; also used by the migration in database.py
+SIGNED_AMOUNT_SQL = f"amount * (CASE WHEN type = '{_INCOME_VALUE}' THEN 1 ELSE -1 END)"
+
 class Transaction(Base):
     __tablename__ = 'transactions'
+    # Balances are read from account_balances, so no index here serves them; the
+    # reporting and listing indexes are created in database.py (TRANSACTION_INDEXES)
+    __table_args__ = (
+        # Finds a withdrawal's deposit (transfer_counterpart)
+        Index('ix_txn_transfer', 'transfer_id'),
+        # The sign comes from type, so amounts themselves are never negative
+        CheckConstraint('amount >= 0', name='ck_transactions_amount_non_negative'),
+    )
     id = Column(Integer, primary_key=True)
     date = Column(Date, default=date.today, nullable=False)
-    type = Column(Enum(TransactionType), nullable=False)
-    amount = Column(Float, nullable=False)
+    # Persist the enum's values rather than its member names, so raw SQL and the
+    # database compare against the same 'INCOME'/'EXPENSE' strings the app uses
+    type = Column(Enum(TransactionType, values_callable=lambda e: [member.value for member in e]), nullable=False)
+    # Money columns are fixed-point in the schema but read back as plain floats (see Money).
+    # SQLite doesn't enforce the scale, so amounts are rounded to cents before they're stored.
+    amount = Column(Money(18, 2, asdecimal=False), nullable=False)
+    # The amount with its sign applied (negative for expenses), computed by the database
+    # so aggregates can SUM one column instead of branching on type per row
+    signed_amount = Column(Money(18, 2, asdecimal=False), Computed(SIGNED_AMOUNT_SQL, persisted=False))
     description = Column(String(255))
     counterparty = Column(String(100))
     is_void = Column(Boolean, default=False)
+    # Month bucket as YYYYMM, so monthly reports group on a stored integer
+    # instead of formatting every date
+    year_month = Column(Integer, default=_year_month_default)
 
     # For Transfers: Lock the rate used and link the pair of transactions
-    exchange_rate = Column(Float, nullable=True)
-    transfer_id = Column(Integer, nullable=True)
+    exchange_rate = Column(Money(18, 8, asdecimal=False), nullable=True)
+    # A transfer's deposit points at its withdrawal's id (indexed by ix_txn_transfer)
+    transfer_id = Column(Integer, ForeignKey('transactions.id'), nullable=True)
 
     # Foreign Keys
     account_id = Column(Integer, ForeignKey('accounts.id'), nullable=False)
     category_id = Column(Integer, ForeignKey('categories.id'), nullable=False)
 
     # Relationships
-    account = relationship("Account", back_populates="transactions")
-    category = relationship("Category", back_populates="transactions")
-    splits = relationship("TransactionSplit", back_populates="parent_transaction", cascade="all, delete-orphan")
+    # Loaded in the same SELECT as the transaction, since describe() and any listing
+    # of transactions needs them (inner joins are safe as both keys are non-nullable)
+    account = relationship("Account", back_populates="transactions", lazy="joined", innerjoin=True)
+    category = relationship("Category", back_populates="transactions", lazy="joined", innerjoin=True)
+    # The splits' foreign key cascades in the database, so deleting a transaction
+    # doesn't need to load its splits first
+    splits = relationship("TransactionSplit", back_populates="parent_transaction", cascade="all, delete-orphan", passive_deletes=True)
+
+    # The amount in whole cents, negated for expenses. Balances are summed from this
+    # in both Python and SQL, and the SQL side accumulates exact integers rather than
+    # floats. Python's round() (half to even) and SQLite's ROUND (half away from zero)
+    # only agree because amounts are stored already rounded to cents (round_amount).
+    @hybrid_property
+    def signed_cents(self):
+        cents = round(self.amount * 100)
+        return cents if self.type is _INCOME else -cents
+
+    @signed_cents.expression
+    def signed_cents(cls):
+        return cast(func.round(cls.signed_amount * 100), Integer)
+
+    @classmethod
+    def bulk_insert(cls, session, rows):
+        """
+        Inserts many transactions with one executemany, bypassing the ORM unit of work.
+        Each row is a dict of column values; date defaults to today and year_month is
+        derived from the date when they are not given.
+        """
+        # Evaluate the date default once rather than once per row
+        today = date.today()
+        prepared = []
+        for row in rows:
+            row = dict(row)
+            row.setdefault('date', today)
+            row.setdefault('year_month', year_month_of(row['date']))
+            row.setdefault('is_void', False)
+            row['amount'] = round_amount(row['amount'])
+            prepared.append(row)
+        if prepared:
+            session.execute(cls.__table__.insert(), prepared)
+            # Core inserts skip the mapper events, so drop the affected accounts' state here
+            _expire_account_balances(session, {row['account_id'] for row in prepared})
+
+    def transfer_counterpart(self):
+        """The other half of this transfer, or None if this isn't a linked transfer."""
+        session = object_session(self)
+        if session is None:
+            return None
+        if self.transfer_id is not None:
+            return session.get(Transaction, self.transfer_id)
+        return session.scalars(select(Transaction).where(Transaction.transfer_id == self.id)).first()
+
+    @classmethod
+    def stream(cls, session, **filters):
+        """
+        Iterates over the transactions matching the given column filters, fetching
+        1000 rows at a time so exports never hold the whole table in memory.
+        Account and category arrive in the same rows through their joined loaders.
+        """
+        stmt = select(cls).filter_by(**filters).order_by(cls.id).execution_options(yield_per=1000)
+        return session.execute(stmt).scalars()
+
+    @validates('amount')
+    def _round_amount(self, key, amount):
+        return round_amount(amount)
+
+    # Keep the month bucket in step when a transaction's date is set or edited
+    @validates('date')
+    def _update_year_month(self, key, day):
+        if day is not None:
+            self.year_month = year_month_of(day)
+        return day
 
     def __repr__(self):
-        return f'<Transaction {self.date} {self.type.value} {self.amount} ({self.account.currency_code})>'
+        # Only column attributes, so printing a transaction never needs its account loaded
+        return f'<Transaction {self.date} {self.type.value} {self.amount} (account {self.account_id})>'
+
+    def describe(self):
+        """A readable one-line summary, including the account's currency."""
+        return f'{self.date} {self.type.value} {self.amount} {self.account.currency_code} ({self.account.name})'
 
 class TransactionSplit(Base):
     __tablename__ = 'transaction_splits'
     id = Column(Integer, primary_key=True)
-    amount = Column(Float, nullable=False)
+    amount = Column(Money(18, 2, asdecimal=False), nullable=False)
     description = Column(String(255))
 
     # Foreign Keys
-    transaction_id = Column(Integer, ForeignKey('transactions.id'), nullable=False)
+    transaction_id = Column(Integer, ForeignKey('transactions.id', ondelete='CASCADE'), nullable=False)
     category_id = Column(Integer, ForeignKey('categories.id'), nullable=False)
 
     # Relationships
     parent_transaction = relationship("Transaction", back_populates="splits")
     category = relationship("Category", back_populates="split_transactions")
 
+    @validates('amount')
+    def _round_amount(self, key, amount):
+        return round_amount(amount)
+
     def __repr__(self):
-        return f'<Split {self.amount} for {self.description}>'
\ No newline at end of file
+        return f'<Split {self.amount} for {self.description}>'
+
+# --- Balance Cache Invalidation ---
+def _reset_balance_cache(account):
+    if account is not None:
+        account.__dict__.pop('_balance_cache', None)
+
+def _expire_account_balances(session, account_ids):
+    """Drops the cached balance and loaded transactions of any of these accounts in the session."""
+    for account_id in account_ids:
+        account = session.identity_map.get(identity_key(Account, account_id))
+        if account is not None:
+            _reset_balance_cache(account)
+            session.expire(account, ['transactions'])
+
+@event.listens_for(Transaction, 'after_insert')
+@event.listens_for(Transaction, 'after_update')
+@event.listens_for(Transaction, 'after_delete')
+def _transaction_changed(mapper, connection, target):
+    """Drops the cached balance of the account a flushed transaction belongs to."""
+    # Read the relationship from __dict__ so this never triggers a lazy load mid-flush
+    _reset_balance_cache(target.__dict__.get('account'))
+    session = object_session(target)
+    if session is not None:
+        _reset_balance_cache(session.identity_map.get(identity_key(Account, target.account_id)))
+
+@event.listens_for(Transaction.amount, 'set')
+@event.listens_for(Transaction.type, 'set')
+@event.listens_for(Transaction.is_void, 'set')
+def _transaction_attribute_set(target, value, oldvalue, initiator):
+    _reset_balance_cache(target.__dict__.get('account'))
+
+@event.listens_for(Account.transactions, 'append')
+@event.listens_for(Account.transactions, 'remove')
+def _account_transactions_changed(target, value, initiator):
+    _reset_balance_cache(target)
+
+@event.listens_for(Account, 'expire')
+@event.listens_for(Account, 'refresh')
+def _account_reloaded(target, *args):
+    _reset_balance_cache(target)